@@ -0,0 +1,132 @@
+"""Cache of chatbot answers for questions that have been asked before.
+
+Questions are matched first by their normalized text and then, to catch light
+rephrasing, by the overlap of their words and word pairs. Word pairs keep the
+order, so "fahrenheit to celsius" doesn't match "celsius to fahrenheit", and
+the numbers in a question must be the same and in the same order.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from moderation import normalize_text
+
+# Filler that doesn't change what is asked. Words that relate the others (to,
+# from, by, of, in, how, why, ...) are kept.
+STOPWORDS = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'what', 'whats', 'does', 'do', 'did',
+    'can', 'could', 'would', 'please', 'me', 'i', 'you', 'it', 'its', 'this', 'that', 'explain',
+    'tell', 'about', 's',
+}
+
+
+def question_terms(normalized):
+    """Words and adjacent word pairs of a question, numbers included"""
+    words = [word for word in normalized.split() if word not in STOPWORDS]
+    return frozenset(words) | frozenset(zip(words, words[1:]))
+
+
+def question_numbers(normalized):
+    return tuple(word for word in normalized.split() if any(ch.isdigit() for ch in word))
+
+
+class AnswerCache:
+    def __init__(self, ttl=24 * 3600, max_entries=2000, similarity=0.9):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._entries = OrderedDict()  # normalized question -> (answer, terms, numbers, stored_at)
+        self._postings = {}            # term -> set of normalized questions containing it
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    def _remove(self, key):
+        terms = self._entries.pop(key)[1]
+        for term in terms:
+            keys = self._postings.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[term]
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[3] > self.ttl:
+            self._remove(key)
+            return None
+        return entry
+
+    def _most_similar(self, terms, numbers):
+        """Cached question closest to these terms, if it is similar enough and asks about the same numbers"""
+        if not terms:
+            return None
+        candidates = set()
+        for term in terms:
+            candidates |= self._postings.get(term, set())
+
+        best_key, best_score = None, self.similarity
+        for key in candidates:
+            _, cached_terms, cached_numbers, _ = self._entries[key]
+            if cached_numbers != numbers:
+                continue  # "4 divided by 12" is not "12 divided by 4"
+            score = len(terms & cached_terms) / len(terms | cached_terms)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def get(self, question):
+        """Cached answer for this question or a close paraphrase of it, or None"""
+        normalized = normalize_text(question)
+        with self._lock:
+            entry = self._fresh(normalized)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(normalized)
+                return entry[0]
+
+            key = self._most_similar(question_terms(normalized), question_numbers(normalized))
+            entry = self._fresh(key) if key else None
+            if entry is not None:
+                self.similar_hits += 1
+                self._entries.move_to_end(key)
+                return entry[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, question, answer):
+        normalized = normalize_text(question)
+        if not normalized or not answer:
+            return
+        terms = question_terms(normalized)
+        with self._lock:
+            if normalized in self._entries:
+                self._remove(normalized)
+            self._entries[normalized] = (answer, terms, question_numbers(normalized), time.time())
+            for term in terms:
+                self._postings.setdefault(term, set()).add(normalized)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def purge(self):
+        """Drop every cached answer and return how many there were"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._postings.clear()
+            return count
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits + self.similar_hits) / lookups if lookups else None,
+            }
@@ -0,0 +1,386 @@
+"""Load test of SchoolNet's hot paths, for comparing commits.
+
+    python benchmark.py --users 500 --posts 5000 --comments 20000 --events 2000
+    python benchmark.py --compare bench_results/<an earlier run>.json
+
+Seeds a synthetic school into a throwaway database, points the app at a local
+fake OpenRouter (see --api-latency and --api-error-rate) and then drives each
+scenario from --concurrency threads for --duration seconds. Prints throughput
+and p50/p99 latency per scenario and saves them, with the commit they ran on,
+as JSON.
+
+The clients go through Flask's test client in the same process as the app, so
+the numbers are for comparing runs on the same machine, not for sizing servers.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('home', 'upload', 'add_comment', 'get_comments', 'get_events', 'login')
+PASSWORD = 'benchmark'
+EMAIL_DOMAIN = 'bench.school'
+HOT_POSTS = 200  # comments go to and are read from the newest posts, like on the feed
+WORDS = ('exam', 'science', 'fair', 'library', 'sports', 'day', 'homework', 'music', 'class', 'trip',
+         'project', 'results', 'holiday', 'notice', 'maths', 'art', 'debate', 'lab', 'club', 'week')
+
+
+class FakeOpenRouter:
+    """Local stand-in for the OpenRouter chat API with a set latency and error rate"""
+
+    def __init__(self, latency=0.2, jitter=0.05, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        """Start serving on a free local port and return the API URL"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status, body = fake.respond(payload)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-openrouter', daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_port}/api/v1/chat/completions'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def respond(self, payload):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.jitter))
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            return 500, {'error': {'message': 'fake upstream error'}}
+
+        text = payload['messages'][-1]['content']
+        if 'JSON object mapping every id' in text:
+            # Batched moderation: one verdict per fenced text, by id
+            content = json.dumps({text_id: 'APPROPRIATE' for text_id in re.findall(r' id="(t\d+)">>>$', text, re.M)})
+        elif payload['messages'][0]['role'] == 'system':
+            content = 'A short, made-up answer for the benchmark.'
+        else:
+            content = 'APPROPRIATE'
+        return 200, {'choices': [{'message': {'content': content}}]}
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def seed_school(schoolnet, rng, users, posts, comments, events, years):
+    """Fill the database with a synthetic school and return what the scenarios need"""
+    db = schoolnet.db
+    User, Post, Comment, Event = schoolnet.User, schoolnet.Post, schoolnet.Comment, schoolnet.Event
+    now = datetime.utcnow()
+    span = timedelta(days=365 * years)
+
+    # Everyone shares one password, so seeding doesn't hash it thousands of times
+    password_hash = schoolnet.password_hasher.hash(PASSWORD)
+    user_rows = []
+    for i in range(users):
+        role = 'admin' if i == 0 else 'teacher' if i % 20 == 1 else 'student'
+        user_rows.append({'email': f'{role}{i}@{EMAIL_DOMAIN}', 'username': f'{role}{i}', 'role': role,
+                          'password_hash': password_hash, 'full_name': words(rng, 2).title(),
+                          'created_at': now - span})
+    db.session.execute(db.insert(User), user_rows)
+    db.session.commit()
+    people = db.session.execute(db.select(User.id, User.email, User.role).order_by(User.id)).all()
+
+    post_rows = []
+    for i in range(posts):
+        created_at = now - span * (1 - i / max(posts, 1))  # oldest first, the newest a moment ago
+        post_rows.append({'post_key': f'bench_{i}', 'title': words(rng, 4).capitalize(),
+                          'description': words(rng, 25), 'post_type': 'announcement', 'filename': '',
+                          'author': rng.choice(people).email, 'pinned': False, 'status': 'published',
+                          'created_at': created_at})
+    db.session.execute(db.insert(Post), post_rows)
+    db.session.commit()
+
+    comment_rows = []
+    for _ in range(comments):
+        post = post_rows[int(len(post_rows) * rng.random() ** 0.3)]  # newer posts get more comments
+        comment_rows.append({'post_id': post['post_key'], 'author_id': rng.choice(people).id,
+                             'content': words(rng, 8), 'status': 'published',
+                             'created_at': post['created_at'] + timedelta(minutes=rng.randint(1, 600))})
+    if comment_rows:
+        db.session.execute(db.insert(Comment), comment_rows)
+        db.session.commit()
+
+    admin_id = people[0].id
+    first_day = date.today() - span
+    event_rows = [{'title': words(rng, 3).title(), 'description': words(rng, 12),
+                   'event_type': rng.choice(('exam', 'holiday', 'cultural')),
+                   'date': first_day + timedelta(days=rng.randrange(2 * 365 * years)),
+                   'created_by': admin_id} for _ in range(events)]
+    if event_rows:
+        db.session.execute(db.insert(Event), event_rows)
+        db.session.commit()
+
+    return {
+        'students': [p.email for p in people if p.role == 'student'],
+        'teachers': [p.email for p in people if p.role != 'student'],
+        'hot_posts': [row['post_key'] for row in post_rows[-HOT_POSTS:]],
+        'first_day': first_day,
+        'days': 2 * 365 * years,
+    }
+
+
+def logged_in_client(app, email):
+    client = app.test_client()
+    response = client.post('/login', data={'email': email, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError(f'Could not log in as {email}: {response.status_code}')
+    return client
+
+
+def scenario_requests(app, school):
+    """name -> (who logs in, expected status, request(client, rng, n))"""
+    def events_month(client, rng, n):
+        start = school['first_day'] + timedelta(days=rng.randrange(school['days']))
+        end = start + timedelta(days=31)
+        return client.get(f'/api/events?from={start.isoformat()}&to={end.isoformat()}')
+
+    return {
+        'home': ('students', 200, lambda client, rng, n: client.get('/')),
+        'upload': ('teachers', 302, lambda client, rng, n: client.post(
+            '/upload', data={'title': words(rng, 4), 'description': words(rng, 20), 'type': 'announcement'})),
+        'add_comment': ('students', 302, lambda client, rng, n: client.post(
+            '/add_comment', data={'post_id': rng.choice(school['hot_posts']), 'content': f'{words(rng, 6)} {n}'})),
+        'get_comments': ('students', 200, lambda client, rng, n: client.get(
+            f"/api/comments/{rng.choice(school['hot_posts'])}")),
+        'get_events': ('students', 200, events_month),
+        # A new client each time, so every request is a real password check
+        'login': (None, 302, lambda client, rng, n: app.test_client().post(
+            '/login', data={'email': rng.choice(school['students']), 'password': PASSWORD})),
+    }
+
+
+def run_scenario(app, school, name, concurrency, duration, warmup, seed):
+    role, expected, send = scenario_requests(app, school)[name]
+    latencies = [[] for _ in range(concurrency)]
+    statuses = [{} for _ in range(concurrency)]
+    start = threading.Barrier(concurrency + 1)
+    deadline = [0.0]
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        client = logged_in_client(app, rng.choice(school[role])) if role else None
+        for n in range(warmup):
+            send(client, rng, -n)
+        start.wait()
+        n = 0
+        while time.perf_counter() < deadline[0]:
+            started = time.perf_counter()
+            response = send(client, rng, n)
+            latencies[index].append(time.perf_counter() - started)
+            statuses[index][response.status_code] = statuses[index].get(response.status_code, 0) + 1
+            response.close()
+            if client is not None and response.status_code == 302:
+                # Redirects would pile up flash messages in the session cookie
+                with client.session_transaction() as session:
+                    session.pop('_flashes', None)
+            n += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    deadline[0] = began + duration
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    merged = sorted(value for values in latencies for value in values)
+    status_counts = {}
+    for counts in statuses:
+        for status, count in counts.items():
+            status_counts[str(status)] = status_counts.get(str(status), 0) + count
+    return summarize(merged, elapsed, status_counts, expected)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))]
+
+
+def summarize(latencies, elapsed, statuses, expected):
+    ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p90_ms': ms(percentile(latencies, 90)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'mean_ms': ms(sum(latencies) / len(latencies) if latencies else None),
+        'errors': sum(count for status, count in statuses.items() if status != str(expected)),
+        'statuses': statuses,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASE_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def print_results(results, previous=None):
+    old = previous['scenarios'] if previous else {}
+    print(f"{'scenario':<14}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in results['scenarios'].items():
+        # A scenario with no successful requests has no throughput or latencies
+        throughput, p50, p99 = ('-' if result.get(key) is None else result[key]
+                                for key in ('throughput_rps', 'p50_ms', 'p99_ms'))
+        line = f"{name:<14}{throughput:>10}{p50:>10}{p99:>10}{result['errors']:>8}"
+        if name in old:
+            changes = []
+            for key, label in (('throughput_rps', 'req/s'), ('p50_ms', 'p50'), ('p99_ms', 'p99')):
+                before, after = old[name].get(key), result.get(key)
+                if before and after is not None:
+                    changes.append(f'{label} {(after - before) / before * 100:+.0f}%')
+            if changes:
+                line += '   vs previous: ' + ', '.join(changes)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--posts', type=int, default=3000)
+    parser.add_argument('--comments', type=int, default=15000)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--years', type=int, default=3, help='years of posts and events')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated, from: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed requests per client first')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='fake OpenRouter latency in seconds')
+    parser.add_argument('--api-jitter', type=float, default=0.05)
+    parser.add_argument('--api-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='results file (default bench_results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark's database")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    fake = FakeOpenRouter(args.api_latency, args.api_jitter, args.api_error_rate, args.seed)
+    workdir = tempfile.mkdtemp(prefix='schoolnet-bench-')
+    # The app reads its settings when it's imported, so they go in first
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'school_app.db')}",
+        'MODERATION_CACHE_DB': os.path.join(workdir, 'moderation_cache.db'),
+        'OPENROUTER_API_URL': fake.start(),
+        'OPENROUTER_API_KEY': 'benchmark',
+        'REQUEST_LOG': '0',
+        'AUTO_MIGRATE': '1',
+    })
+    os.environ.pop('LIVE_EVENTS_DB', None)
+    sys.path.insert(0, BASE_DIR)
+    import app as schoolnet
+
+    app = schoolnet.create_app()
+    commit, dirty = git_commit()
+    results = {
+        'run': {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': commit,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'settings': {key: value for key, value in vars(args).items() if key not in ('out', 'compare', 'keep')},
+        },
+        'scenarios': {},
+    }
+    try:
+        with app.app_context():
+            schoolnet.prepare_app()
+            started = time.perf_counter()
+            school = seed_school(schoolnet, random.Random(args.seed), args.users, args.posts,
+                                 args.comments, args.events, args.years)
+            results['run']['seed_seconds'] = round(time.perf_counter() - started, 2)
+        print(f"Seeded {args.users} users, {args.posts} posts, {args.comments} comments and "
+              f"{args.events} events in {results['run']['seed_seconds']} s")
+
+        for name in scenarios:
+            results['scenarios'][name] = run_scenario(app, school, name, args.concurrency, args.duration,
+                                                      args.warmup, args.seed)
+            # Let posts and comments from this scenario finish moderation before the next one
+            schoolnet.moderation_queue.join()
+            print(f"{name}: {results['scenarios'][name]['throughput_rps']} req/s")
+
+        results['fake_openrouter'] = {'calls': fake.calls, 'errors': fake.errors}
+        results['database'] = schoolnet.query_timer.stats(top=5)
+    finally:
+        fake.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Saved first, so a problem printing the table doesn't lose the run
+    out = args.out or os.path.join(BASE_DIR, 'bench_results', '{}-{}.json'.format(
+        datetime.now().strftime('%Y%m%d-%H%M%S'), (commit or 'nocommit')[:8]))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, default=str)
+    print_results(results, previous)
+    print(f"Saved results to {out}" + (f" (database kept in {workdir})" if args.keep else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Database engine settings and query timing.
+
+SQLite by default, tuned for a multi-threaded server: WAL so readers don't wait
+for a writer, a busy timeout instead of "database is locked" errors, and a pool
+of connections the threads reuse. Set DATABASE_URL to use PostgreSQL (or any
+other database SQLAlchemy supports) instead.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from metrics import Histogram, log_json
+
+PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'  # bound parameter in any DB-API paramstyle
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',    # readers keep reading while one connection writes
+    'synchronous': 'NORMAL',  # safe with WAL, only the last commits can be lost on power loss
+    'temp_store': 'MEMORY',
+    'cache_size': -16000,     # 16 MB page cache per connection
+}
+
+
+def database_uri(url, default_path):
+    """SQLAlchemy URI for DATABASE_URL, or the SQLite file when it isn't set"""
+    if not url:
+        return f'sqlite:///{default_path}'
+    if url.startswith('postgres://'):
+        # Heroku-style URLs, which SQLAlchemy no longer accepts
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(uri, pool_size=10, max_overflow=10, busy_timeout=5):
+    """SQLALCHEMY_ENGINE_OPTIONS for this database"""
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}  # a single in-memory database, nothing to pool
+    options = {'pool_size': pool_size, 'max_overflow': max_overflow}
+    if uri.startswith('sqlite'):
+        # One connection per thread from the pool, never shared between threads at the same time
+        options['connect_args'] = {'timeout': busy_timeout, 'check_same_thread': False}
+    else:
+        options['pool_pre_ping'] = True
+        options['pool_recycle'] = 1800
+    return options
+
+
+def tune_sqlite(engine, busy_timeout=5, mmap_mb=256):
+    """Set SQLITE_PRAGMAS (plus busy timeout and mmap size) on each new connection"""
+    pragmas = dict(SQLITE_PRAGMAS, busy_timeout=busy_timeout * 1000, mmap_size=mmap_mb * 1024 * 1024)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+class QueryTimer:
+    """Times every statement run on an engine, overall and per statement shape"""
+
+    def __init__(self, slow_seconds=0.25, max_statements=200, on_query=None, log=log_json):
+        self.slow_seconds = slow_seconds
+        self.on_query = on_query  # called with each statement's duration, e.g. to total them per request
+        self.log = log
+        self.max_statements = max_statements
+        self.query_time = Histogram()
+        self.slow_queries = 0
+        self._statements = OrderedDict()  # statement shape -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def install(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(engine, 'handle_error', self._failed)
+
+    # Start times are kept per cursor: a statement that raises never reaches _after,
+    # and handle_error drops its entry so it doesn't linger on the connection
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', {})[id(cursor)] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop(id(cursor))
+        self.query_time.observe(elapsed)
+        if self.on_query is not None:
+            self.on_query(elapsed)
+        shape = statement_shape(statement)
+        with self._lock:
+            entry = self._statements.get(shape)
+            if entry is None:
+                entry = self._statements[shape] = [0, 0.0, 0.0]
+                if len(self._statements) > self.max_statements:
+                    self._statements.popitem(last=False)
+            else:
+                self._statements.move_to_end(shape)
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            if elapsed >= self.slow_seconds:
+                self.slow_queries += 1
+        if elapsed >= self.slow_seconds:
+            self.log('slow_query', level='warning', duration_ms=round(elapsed * 1000, 1), statement=shape)
+
+    def _failed(self, context):
+        # ExceptionContext.cursor isn't filled in, the execution context has the cursor
+        if context.connection is not None and context.execution_context is not None:
+            context.connection.info.get('query_started', {}).pop(id(context.execution_context.cursor), None)
+
+    def stats(self, top=10):
+        with self._lock:
+            statements = sorted(self._statements.items(), key=lambda item: item[1][1], reverse=True)[:top]
+            slow_queries = self.slow_queries
+        return {
+            'query_time': self.query_time.summary(),
+            'slow_queries': slow_queries,
+            'top_statements': [
+                {'statement': shape, 'count': count, 'total': total, 'avg': total / count, 'max': longest}
+                for shape, (count, total, longest) in statements
+            ],
+        }
+
+
+def statement_shape(statement):
+    """Statement with whitespace collapsed and IN (...) lists shortened, for grouping"""
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return re.sub(rf'\(\s*{PLACEHOLDER}(?:\s*,\s*{PLACEHOLDER})+\s*\)', '(?, ...)', statement)[:500]
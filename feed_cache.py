@@ -0,0 +1,53 @@
+"""In-memory read-through cache for the feed.
+
+Entries are tagged with the feed version they were built from. The version is a
+counter in the database that every write to posts, comments, pins or users bumps
+in the same transaction, so each worker process notices changes made by the
+others the next time it reads the counter and rebuilds only then.
+"""
+import threading
+from datetime import datetime
+
+
+class FeedCache:
+    def __init__(self):
+        self._entries = {}  # key -> (version, expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        """Cached value for key at this version, calling build() on a miss.
+
+        build returns (value, expires_at); expires_at is a datetime after which
+        the value is stale even without a write (e.g. a scheduled pin), or None.
+        """
+        now = datetime.now()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and (entry[1] is None or now < entry[1]):
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # Built outside the lock, two requests racing on a miss just both build it
+        value, expires_at = build()
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current[0] <= version:
+                self._entries[key] = (version, expires_at, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+            }
@@ -0,0 +1,101 @@
+"""iCalendar (RFC 5545) feed of school events for calendar apps to subscribe to.
+
+The feed is only re-rendered when the events change, and then only the VEVENTs
+of events it hasn't seen are rendered; the rest come from a per-event cache.
+"""
+import threading
+from datetime import timedelta
+
+PRODID = '-//SchoolNet//School Calendar//EN'
+REFRESH_INTERVAL = 'PT1H'  # how often subscribed apps are asked to poll
+
+
+def escape_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    """Split a content line into 75-octet pieces, continuation lines start with a space"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    pieces = []
+    while data:
+        size = min(len(data), 75 if not pieces else 74)
+        # Don't cut a UTF-8 sequence in half
+        while size < len(data) and (data[size] & 0xC0) == 0x80:
+            size -= 1
+        pieces.append(data[:size].decode('utf-8'))
+        data = data[size:]
+    return '\r\n '.join(pieces)
+
+
+def vevent(event_id, title, description, event_type, date, created_at):
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:event-{event_id}@schoolnet',
+        f"DTSTAMP:{created_at.strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART;VALUE=DATE:{date.strftime('%Y%m%d')}",
+        f"DTEND;VALUE=DATE:{(date + timedelta(days=1)).strftime('%Y%m%d')}",
+        f'SUMMARY:{escape_text(title)}',
+        f'CATEGORIES:{escape_text(event_type)}',
+    ]
+    if description:
+        lines.append(f'DESCRIPTION:{escape_text(description)}')
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) + '\r\n' for line in lines)
+
+
+class IcsFeed:
+    def __init__(self, name):
+        self.name = name
+        self._vevents = {}  # event id -> rendered VEVENT
+        self._version = None
+        self._body = None
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.full_renders = 0
+
+    @property
+    def last_id(self):
+        return max(self._vevents, default=0)
+
+    def current(self, version):
+        """The feed if it was rendered for this version of the events, else None"""
+        with self._lock:
+            if version == self._version:
+                return self._body
+            return None
+
+    def needs_full_render(self, new_count, total):
+        """True if adding new_count events won't reach total, i.e. some were deleted"""
+        return len(self._vevents) + new_count != total
+
+    def update(self, version, events, full=False):
+        """Render these events into the feed and return the new feed.
+
+        events are (id, title, description, event_type, date, created_at) tuples;
+        with full=True they replace everything cached.
+        """
+        with self._lock:
+            if full:
+                self._vevents = {}
+                self.full_renders += 1
+            for event in events:
+                self._vevents[event[0]] = vevent(*event)
+            self.renders += 1
+
+            header = ''.join(fold(line) + '\r\n' for line in [
+                'BEGIN:VCALENDAR',
+                'VERSION:2.0',
+                f'PRODID:{PRODID}',
+                'CALSCALE:GREGORIAN',
+                'METHOD:PUBLISH',
+                f'X-WR-CALNAME:{escape_text(self.name)}',
+                f'REFRESH-INTERVAL;VALUE=DURATION:{REFRESH_INTERVAL}',
+                f'X-PUBLISHED-TTL:{REFRESH_INTERVAL}',
+            ])
+            self._body = header + ''.join(self._vevents.values()) + 'END:VCALENDAR\r\n'
+            self._version = version
+            return self._body
@@ -0,0 +1,171 @@
+"""Push channel for live feed updates.
+
+Routes publish small events (post created, comment added, post deleted) to a
+LiveHub, which fans them out to every client connected to the Server-Sent
+Events stream. In a single process the hub hands events straight to its
+subscribers. With several worker processes, give it an EventLog: events are
+appended to a shared SQLite file that every process tails, so an event
+published in one worker reaches clients connected to any of them.
+"""
+import itertools
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from metrics import log_json
+
+
+class EventLog:
+    """Events shared between worker processes through a SQLite file"""
+
+    def __init__(self, path, keep_seconds=600):
+        self.path = path
+        self.keep_seconds = keep_seconds
+        self._conn = None  # opened on first use, so each worker process has its own
+        self._lock = threading.Lock()
+
+    @property
+    def _db(self):
+        # Only used with self._lock held
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS live_event '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT, data TEXT, created_at REAL)')
+            self._conn.commit()
+        return self._conn
+
+    def append(self, event, data):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT INTO live_event (event, data, created_at) VALUES (?, ?, ?)',
+                             (event, data, now))
+            self._db.execute('DELETE FROM live_event WHERE created_at < ?', (now - self.keep_seconds,))
+            self._db.commit()
+
+    def last_id(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(MAX(id), 0) FROM live_event').fetchone()[0]
+
+    def read_after(self, event_id):
+        """Events newer than event_id as (id, event, data), oldest first"""
+        with self._lock:
+            return self._db.execute('SELECT id, event, data FROM live_event WHERE id > ? ORDER BY id',
+                                    (event_id,)).fetchall()
+
+
+class LiveHub:
+    def __init__(self, log=None, backlog=200, queue_size=100, poll_interval=0.25, max_clients=None,
+                 log_event=log_json):
+        self.log = log
+        self.log_event = log_event  # for errors, self.log is the shared EventLog
+        self.queue_size = queue_size
+        self.max_clients = max_clients  # each stream holds a worker thread, so don't take them all
+        self.poll_interval = poll_interval
+        self._recent = deque(maxlen=backlog)  # replayed to clients reconnecting with Last-Event-ID
+        self._subscribers = set()
+        self._ids = itertools.count(1)
+        self._tail_thread = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.dropped_clients = 0
+        self.refused_clients = 0
+
+    def publish(self, event, data):
+        """Send an event to every connected client, in this process and (with a log) the others"""
+        payload = json.dumps(data)
+        with self._lock:
+            self.published += 1
+        if self.log is not None:
+            self.start()
+            self.log.append(event, payload)  # delivered by the tail thread, here like everywhere else
+        else:
+            self._deliver([(next(self._ids), event, payload)])
+
+    def start(self):
+        """Start tailing the shared log (safe to call more than once)"""
+        with self._lock:
+            if self.log is None or self._tail_thread is not None:
+                return
+            self._tail_thread = threading.Thread(target=self._tail, args=(self.log.last_id(),),
+                                                 name='live-events', daemon=True)
+            self._tail_thread.start()
+
+    def _tail(self, last_id):
+        while True:
+            try:
+                messages = self.log.read_after(last_id)
+            except sqlite3.Error as e:
+                self.log_event('live_event_log_error', level='error', error=str(e))
+                messages = []
+            if messages:
+                last_id = messages[-1][0]
+                self._deliver(messages)
+            time.sleep(self.poll_interval)
+
+    def _deliver(self, messages):
+        with self._lock:
+            self._recent.extend(messages)
+            subscribers = list(self._subscribers)
+        delivered = 0
+        for subscriber in subscribers:
+            try:
+                for message in messages:
+                    subscriber.messages.put_nowait(message)
+                    delivered += 1
+            except queue.Full:
+                # The client stopped reading, drop it instead of buffering for it forever.
+                # Its stream ends and the browser reconnects with Last-Event-ID.
+                subscriber.closed = True
+                self.unsubscribe(subscriber)
+                with self._lock:
+                    self.dropped_clients += 1
+        with self._lock:
+            self.delivered += delivered
+
+    def subscribe(self, last_event_id=None):
+        """New Subscription for one client.
+
+        Events after last_event_id that are still in the backlog are queued first.
+        Returns None when max_clients are already connected.
+        """
+        self.start()
+        subscriber = Subscription(self.queue_size)
+        with self._lock:
+            if self.max_clients is not None and len(self._subscribers) >= self.max_clients:
+                self.refused_clients += 1
+                return None
+            if last_event_id is not None:
+                missed = [message for message in self._recent if message[0] > last_event_id]
+                for message in missed[-self.queue_size:]:
+                    subscriber.messages.put_nowait(message)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._subscribers),
+                'published': self.published,
+                'delivered': self.delivered,
+                'dropped_clients': self.dropped_clients,
+                'refused_clients': self.refused_clients,
+                'max_clients': self.max_clients,
+                'shared_log': self.log is not None,
+            }
+
+
+class Subscription:
+    """(id, event, data) messages waiting to be sent to one client"""
+
+    def __init__(self, maxsize):
+        self.messages = queue.Queue(maxsize)
+        self.closed = False  # set when the hub gave up on this client
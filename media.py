@@ -0,0 +1,118 @@
+"""Resized WebP copies of uploaded images.
+
+Every uploaded image gets up to three variants next to the original, named
+`<name>.<variant>.webp`: a small avatar, a feed-width copy and a capped full-size
+copy. Their actual pixel widths, which srcset needs, are kept beside them in
+`<name>.variants.json`. Variants have EXIF and other metadata stripped. Templates use image_url()
+and image_srcset() to pick them, falling back to the original when a variant
+doesn't exist (old uploads, GIFs, or Pillow not installed).
+"""
+import json
+import os
+from functools import lru_cache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, originals are served without it
+    Image = None
+
+# Variant name -> longest side in pixels, smallest first
+IMAGE_VARIANTS = {
+    'avatar': 96,
+    'feed': 720,
+    'full': 1600,
+}
+WEBP_QUALITY = 80
+
+
+def variant_name(filename, variant):
+    return f"{os.path.splitext(filename)[0]}.{variant}.webp"
+
+
+def widths_name(filename):
+    return f"{os.path.splitext(filename)[0]}.variants.json"
+
+
+def make_image_variants(folder, filename, source=None):
+    """Write the WebP variants of an uploaded image and return {variant: width}.
+
+    The image is read from `source` when given (e.g. the upload's temp file before
+    it is stored as `filename`). Variants bigger than the original are skipped,
+    the largest one kept is never upscaled. Files Pillow can't read are left alone.
+    """
+    if Image is None:
+        return {}
+
+    made = {}
+    os.makedirs(os.path.dirname(os.path.join(folder, filename)), exist_ok=True)
+    with Image.open(source or os.path.join(folder, filename)) as img:
+        # Animated images get no variants, only the (empty) list of widths
+        if not getattr(img, 'is_animated', False):
+            # Let the JPEG decoder scale down while reading, much faster for phone photos
+            img.draft('RGB', (max(IMAGE_VARIANTS.values()),) * 2)
+            img = ImageOps.exif_transpose(img)
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+
+            for variant, size in IMAGE_VARIANTS.items():
+                resized = img.copy()
+                resized.thumbnail((size, size), Image.LANCZOS)
+                # No exif/icc arguments, so the WebP carries no metadata
+                resized.save(os.path.join(folder, variant_name(filename, variant)), 'WEBP',
+                             quality=WEBP_QUALITY, method=4)
+                made[variant] = resized.width
+                if max(img.size) <= size:
+                    break  # the larger variants would be the same image
+
+    # Written after the variants, so a reader that finds it finds them too
+    widths_path = os.path.join(folder, widths_name(filename))
+    with open(widths_path + '.tmp', 'w') as f:
+        json.dump(made, f)
+    os.replace(widths_path + '.tmp', widths_path)
+    available_variants.cache_clear()
+    return made
+
+
+@lru_cache(maxsize=4096)
+def available_variants(folder, filename):
+    """Variants that exist on disk for this upload, as {variant: (filename, width)}.
+
+    The width is None for variants made before their widths were recorded, if
+    Pillow isn't there to measure them.
+    """
+    try:
+        with open(os.path.join(folder, widths_name(filename))) as f:
+            widths = json.load(f)
+    except (OSError, ValueError):
+        widths = {}
+    found = {}
+    for variant in IMAGE_VARIANTS:
+        name = variant_name(filename, variant)
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            continue
+        width = widths.get(variant)
+        if width is None and Image is not None:
+            with Image.open(path) as img:  # only reads the header
+                width = img.width
+        found[variant] = (name, width)
+    return found
+
+
+def pick_variant(folder, filename, variant):
+    """File name to serve for this variant: the variant itself, the next larger one, or the original"""
+    found = available_variants(folder, filename)
+    names = list(IMAGE_VARIANTS)
+    for candidate in names[names.index(variant):]:
+        if candidate in found:
+            return found[candidate][0]
+    # Only smaller variants exist when the original is small, the largest of them is the whole image
+    for candidate in reversed(names):
+        if candidate in found:
+            return found[candidate][0]
+    return filename
+
+
+def srcset_entries(folder, filename):
+    """(file name, actual width) pairs for a srcset attribute, empty if there are no variants"""
+    found = available_variants(folder, filename)
+    return [(name, width) for name, width in found.values() if width]
@@ -0,0 +1,193 @@
+"""Small thread-safe metric types used for SchoolNet's internal stats,
+the Prometheus text format they are exported in, and the JSON log line format."""
+import json
+import math
+import threading
+from datetime import datetime, timezone
+
+# Upper bounds in seconds, tuned for HTTP calls and queue waits
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Upper bounds for the number of SQL queries a request makes
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def log_json(event, level='info', **fields):
+    """Write one JSON log line to stdout.
+
+    The helpers in the other modules take a `log` callback with this signature
+    and fall back to this; the app passes its log_event, which adds request ids.
+    """
+    record = {'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'level': level, 'event': event}
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
+
+
+class Histogram:
+    """Bucketed distribution of observed values (usually durations in seconds)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self._sum += value
+            self._count += 1
+
+    def percentile(self, q):
+        """Approximate percentile (0-100), reported as the upper bound of its bucket"""
+        with self._lock:
+            if not self._count:
+                return None
+            target = self._count * q / 100.0
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+                seen += count
+                if seen >= target:
+                    return bound
+        return float('inf')
+
+    def snapshot(self):
+        """Count, sum and cumulative bucket counts"""
+        with self._lock:
+            cumulative = []
+            running = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+                running += count
+                cumulative.append((bound, running))
+            return {'count': self._count, 'sum': self._sum, 'buckets': cumulative}
+
+    def summary(self):
+        """Short JSON-friendly description for stats endpoints"""
+        snap = self.snapshot()
+        return {
+            'count': snap['count'],
+            'avg': snap['sum'] / snap['count'] if snap['count'] else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+class Counter:
+    """Thread-safe running totals keyed by a tuple of label values"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def items(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+
+class RequestMetrics:
+    """Per-route request counts, latency, SQL work and response sizes"""
+
+    def __init__(self):
+        self.requests = Counter()        # (endpoint, method, status) -> requests
+        self.response_bytes = Counter()  # (endpoint,) -> bytes sent
+        self.latency = {}      # endpoint -> Histogram of seconds
+        self.sql_queries = {}  # endpoint -> Histogram of queries per request
+        self.sql_time = {}     # endpoint -> Histogram of seconds spent in SQL per request
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, method, status, seconds, queries=0, sql_seconds=0.0, size=None):
+        with self._lock:
+            latency = self.latency.setdefault(endpoint, Histogram())
+            sql_queries = self.sql_queries.setdefault(endpoint, Histogram(QUERY_COUNT_BUCKETS))
+            sql_time = self.sql_time.setdefault(endpoint, Histogram())
+        latency.observe(seconds)
+        sql_queries.observe(queries)
+        sql_time.observe(sql_seconds)
+        self.requests.inc(endpoint, method, str(status))
+        if size:
+            self.response_bytes.inc(endpoint, amount=size)
+
+    def export(self, out, prefix='http'):
+        for (endpoint, method, status), count in self.requests.items():
+            out.counter(f'{prefix}_requests_total', count, 'Requests served',
+                        endpoint=endpoint, method=method, status=status)
+        for (endpoint,), size in self.response_bytes.items():
+            out.counter(f'{prefix}_response_bytes_total', size, 'Response body bytes sent', endpoint=endpoint)
+        with self._lock:
+            families = [
+                (f'{prefix}_request_duration_seconds', 'Time to build the response', dict(self.latency)),
+                (f'{prefix}_request_sql_queries', 'SQL queries run per request', dict(self.sql_queries)),
+                (f'{prefix}_request_sql_seconds', 'Time spent in SQL per request', dict(self.sql_time)),
+            ]
+        for name, help_text, histograms in families:
+            for endpoint, histogram in sorted(histograms.items()):
+                out.histogram(name, histogram, help_text, endpoint=endpoint)
+
+
+class PrometheusText:
+    """Collects samples and renders them in the Prometheus text exposition format"""
+
+    def __init__(self, prefix='schoolnet_'):
+        self.prefix = prefix
+        self._families = {}  # name -> (type, help, sample lines), in the order first seen
+
+    def _add(self, name, kind, help_text, lines):
+        name = self.prefix + name
+        family = self._families.setdefault(name, (kind, help_text, []))
+        family[2].extend(lines)
+
+    def gauge(self, name, value, help_text='', **labels):
+        if value is not None:
+            self._add(name, 'gauge', help_text, [self.sample(self.prefix + name, labels, value)])
+
+    def counter(self, name, value, help_text='', **labels):
+        if value is not None:
+            self._add(name, 'counter', help_text, [self.sample(self.prefix + name, labels, value)])
+
+    def histogram(self, name, histogram, help_text='', **labels):
+        full_name = self.prefix + name
+        snap = histogram.snapshot()
+        lines = [self.sample(f'{full_name}_bucket', dict(labels, le=self.number(bound)), count)
+                 for bound, count in snap['buckets']]
+        lines.append(self.sample(f'{full_name}_sum', labels, snap['sum']))
+        lines.append(self.sample(f'{full_name}_count', labels, snap['count']))
+        self._add(name, 'histogram', help_text, lines)
+
+    def render(self):
+        out = []
+        for name, (kind, help_text, lines) in self._families.items():
+            if help_text:
+                out.append(f'# HELP {name} {help_text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+    @classmethod
+    def sample(cls, name, labels, value):
+        if labels:
+            pairs = ','.join(f'{key}="{cls.escape(str(val))}"' for key, val in labels.items())
+            name = f'{name}{{{pairs}}}'
+        return f'{name} {cls.number(value)}'
+
+    @staticmethod
+    def number(value):
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, float):
+            if math.isinf(value):
+                return '+Inf' if value > 0 else '-Inf'
+            return repr(value)
+        return str(value)
+
+    @staticmethod
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
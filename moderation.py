@@ -0,0 +1,404 @@
+"""Background content moderation.
+
+Posts and comments are saved as 'pending' and handed to a ModerationQueue. A small
+pool of worker threads asks the moderation API for a verdict and reports it back
+through a callback, so a slow API never holds up the request that created them.
+
+Before anything is sent to the API, ContentModerator tries a local word list and
+a cache of earlier verdicts, so repeated comments like "nice!" cost nothing.
+Whatever is left is grouped by ModerationBatcher into one API call per batch.
+"""
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import Histogram, log_json
+
+
+class ModerationQueue:
+    def __init__(self, check, on_verdict, workers=2, log=log_json):
+        self.check = check            # text -> True if the text is inappropriate
+        self.on_verdict = on_verdict  # (kind, item_id, rejected) -> None
+        self.workers = workers
+        self.log = log
+        self.jobs = queue.Queue()
+        self.wait_time = Histogram()   # time spent waiting in the queue
+        self.check_time = Histogram()  # time spent getting a verdict
+        self.processed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads (safe to call more than once)"""
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'moderation-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, kind, item_id, text):
+        """Queue an item for moderation and return straight away"""
+        self.start()
+        self.jobs.put((kind, item_id, text, time.monotonic()))
+
+    def join(self):
+        """Block until every queued item has a verdict"""
+        self.jobs.join()
+
+    def _run(self):
+        while True:
+            kind, item_id, text, queued_at = self.jobs.get()
+            started = time.monotonic()
+            self.wait_time.observe(started - queued_at)
+            with self._lock:
+                self.in_flight += 1
+            try:
+                try:
+                    rejected = self.check(text)
+                except Exception as e:
+                    # Same as the inline check used to do: fail open
+                    self.log('moderation_check_failed', level='error', kind=kind, item_id=item_id, error=repr(e))
+                    rejected = False
+                    with self._lock:
+                        self.errors += 1
+                self.check_time.observe(time.monotonic() - started)
+
+                try:
+                    self.on_verdict(kind, item_id, rejected)
+                except Exception as e:
+                    self.log('moderation_verdict_failed', level='error', kind=kind, item_id=item_id,
+                             error=repr(e))
+                    with self._lock:
+                        self.errors += 1
+
+                with self._lock:
+                    self.processed += 1
+                    if rejected:
+                        self.rejected += 1
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self.jobs.task_done()
+
+    def stats(self):
+        with self._lock:
+            counters = {
+                'queue_depth': self.jobs.qsize(),
+                'in_flight': self.in_flight,
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'workers': len(self._threads),
+            }
+        counters['wait_seconds'] = self.wait_time.summary()
+        counters['check_seconds'] = self.check_time.summary()
+        return counters
+
+
+# --- verdict cache and local pre-filter ---
+
+# Words that are always rejected without asking the API. Only words with no
+# innocent use in school work belong here: 'dick' (Moby Dick), 'bitch' (a female
+# dog), 'retard' (to slow down) and the like are left to the remote check, which
+# sees the context.
+DEFAULT_BLOCKLIST = (
+    'fuck', 'fucking', 'fucker', 'motherfucker', 'shit', 'bullshit', 'asshole', 'cunt', 'nigger', 'faggot',
+)
+
+# Short, common replies that are always fine
+DEFAULT_ALLOWLIST = (
+    'nice', 'nice one', 'congrats', 'congratulations', 'thanks', 'thank you', 'thank you so much',
+    'well done', 'great', 'great job', 'good job', 'awesome', 'amazing', 'wow', 'cool', 'ok', 'okay',
+    'yes', 'no', 'hi', 'hello', 'good morning', 'good luck', 'all the best', 'happy birthday',
+    'see you', 'agreed', 'same', 'lol',
+)
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace so near-identical texts match"""
+    cleaned = ''.join(ch if ch.isalnum() else ' ' for ch in text.lower())
+    return ' '.join(cleaned.split())
+
+
+class WordMatcher:
+    """Aho-Corasick automaton that finds whole words from a list in one pass over the text"""
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for word in words:
+            word = normalize_text(word)
+            if word:
+                self._add(word)
+        self._build()
+
+    def _add(self, word):
+        state = 0
+        for ch in word:
+            if ch not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][ch] = len(self._goto) - 1
+            state = self._goto[state][ch]
+        self._output[state] = self._output[state] + (len(word),)
+
+    def _build(self):
+        pending = list(self._goto[0].values())
+        while pending:
+            state = pending.pop(0)
+            for ch, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def search(self, text):
+        """True if any listed word appears in the (normalized) text as a whole word"""
+        state = 0
+        for end, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for length in self._output[state]:
+                start = end - length + 1
+                before_ok = start == 0 or text[start - 1] == ' '
+                after_ok = end + 1 == len(text) or text[end + 1] == ' '
+                if before_ok and after_ok:
+                    return True
+        return False
+
+
+class VerdictCache:
+    """LRU cache of moderation verdicts keyed by content hash, with a TTL.
+
+    Entries are written through to a small SQLite file so they survive restarts.
+    The file is opened and read on first use, not when the cache is created, so
+    each worker process gets its own connection.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600, max_entries=10000, log=log_json):
+        self.path = path
+        self.log = log
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (rejected, stored_at)
+        self._lock = threading.Lock()
+        self._db = None
+        self._loaded = not path
+
+    def _load(self):
+        """Open the SQLite file and read the saved verdicts (called with the lock held)"""
+        self._loaded = True
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS verdict (key TEXT PRIMARY KEY, rejected INTEGER, stored_at REAL)')
+        self._db.execute('DELETE FROM verdict WHERE stored_at < ?', (time.time() - self.ttl,))
+        rows = self._db.execute('SELECT key, rejected, stored_at FROM verdict ORDER BY stored_at DESC LIMIT ?',
+                                (self.max_entries,)).fetchall()
+        for key, rejected, stored_at in reversed(rows):
+            self._entries[key] = (bool(rejected), stored_at)
+        self._db.commit()
+
+    @staticmethod
+    def key(normalized):
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Cached verdict (True = rejected) or None"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            rejected, stored_at = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return rejected
+
+    def put(self, key, rejected):
+        now = time.time()
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._entries[key] = (rejected, now)
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            if self._db is not None:
+                try:
+                    self._db.execute('INSERT OR REPLACE INTO verdict (key, rejected, stored_at) VALUES (?, ?, ?)',
+                                     (key, int(rejected), now))
+                    self._db.executemany('DELETE FROM verdict WHERE key = ?', [(k,) for k in evicted])
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    # Locked or full: the verdict is still cached in memory and
+                    # must reach the caller, or flagged text would fail open
+                    self.log('moderation_cache_write_failed', level='warning', error=str(e))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ContentModerator:
+    """Decides whether text is inappropriate, calling the remote API only when it has to.
+
+    Order: local word lists, then the verdict cache, then `remote(text)`. The remote
+    check should raise on failure; failures are not cached.
+    """
+
+    def __init__(self, remote, cache=None, blocklist=DEFAULT_BLOCKLIST, allowlist=DEFAULT_ALLOWLIST):
+        self.remote = remote
+        self.cache = cache if cache is not None else VerdictCache()
+        self.blocked = WordMatcher(blocklist)
+        self.allowed = {normalize_text(phrase) for phrase in allowlist}
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.local_decisions = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.remote_calls = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def local_verdict(self, normalized):
+        """True/False if the text can be decided locally, otherwise None"""
+        if not normalized or normalized in self.allowed:
+            return False
+        if self.blocked.search(normalized):
+            return True
+        return None
+
+    def check(self, text):
+        self._count('checks')
+        normalized = normalize_text(text)
+
+        verdict = self.local_verdict(normalized)
+        if verdict is not None:
+            self._count('local_decisions')
+            return verdict
+
+        key = self.cache.key(normalized)
+        verdict = self.cache.get(key)
+        if verdict is not None:
+            self._count('cache_hits')
+            return verdict
+        self._count('cache_misses')
+
+        self._count('remote_calls')
+        verdict = bool(self.remote(text))
+        self.cache.put(key, verdict)
+        return verdict
+
+    def stats(self):
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            skipped = self.local_decisions + self.cache_hits
+            return {
+                'checks': self.checks,
+                'local_decisions': self.local_decisions,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'remote_calls': self.remote_calls,
+                'cache_entries': len(self.cache),
+                'cache_hit_ratio': self.cache_hits / lookups if lookups else None,
+                'remote_skip_ratio': skipped / self.checks if self.checks else None,
+            }
+
+
+# --- micro-batching of remote checks ---
+
+class ModerationBatcher:
+    """Collects texts for a few milliseconds and checks them with one API call.
+
+    `remote_batch(texts)` must return one verdict (True = inappropriate) per text,
+    in order. `check(text)` blocks the caller until its batch is back; if the batch
+    call fails, every caller in it gets the exception so the caller can fail open.
+    """
+
+    def __init__(self, remote_batch, max_batch=8, max_wait=0.02, concurrency=4):
+        self.remote_batch = remote_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._senders = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='moderation-batch')
+        self.batch_size = Histogram(buckets=tuple(range(1, max_batch + 1)))
+        self.batch_time = Histogram()
+        self.batches = 0
+        self.failed_batches = 0
+
+    def check(self, text):
+        future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='moderation-batcher', daemon=True)
+                self._thread.start()
+            self._pending.append((text, future))
+            self._cond.notify()
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Give other texts a moment to join this batch
+                deadline = time.monotonic() + self.max_wait
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        started = time.monotonic()
+        try:
+            verdicts = self.remote_batch([text for text, _ in batch])
+            if len(verdicts) != len(batch):
+                raise ValueError(f"expected {len(batch)} verdicts, got {len(verdicts)}")
+        except Exception as e:
+            with self._cond:
+                self.failed_batches += 1
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), verdict in zip(batch, verdicts):
+                future.set_result(bool(verdict))
+        finally:
+            self.batch_time.observe(time.monotonic() - started)
+            self.batch_size.observe(len(batch))
+            with self._cond:
+                self.batches += 1
+
+    def stats(self):
+        size = self.batch_size.snapshot()
+        with self._cond:
+            return {
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'pending': len(self._pending),
+                'items': int(size['sum']),
+                'avg_batch_size': size['sum'] / size['count'] if size['count'] else None,
+                'batch_seconds': self.batch_time.summary(),
+            }
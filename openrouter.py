@@ -0,0 +1,290 @@
+"""Shared HTTP client for the OpenRouter API.
+
+Moderation and the chatbot both go through one OpenRouterClient so they share a
+pool of keep-alive connections. Calls that couldn't connect or got a 429/5xx are
+retried with jittered backoff (a read timeout isn't, it already took the whole
+timeout), and a circuit breaker stops calling a failing upstream for a while so
+callers drop straight to their fallback instead of waiting on timeouts.
+"""
+import json
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Histogram
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class OpenRouterUnavailable(Exception):
+    """Raised without calling the API when it is known to be failing or overloaded"""
+
+
+class CircuitBreaker:
+    """Opens when the error rate over the last `window` calls crosses `threshold`.
+
+    While open every call is refused. After `cooldown` seconds one trial call is
+    let through; its result closes the breaker again or re-opens it. allow()
+    says which kind of call the caller got, to be passed back to record(), so
+    a call let through before the breaker opened can't settle the trial.
+    """
+
+    def __init__(self, threshold=0.5, window=20, min_calls=5, cooldown=30):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._results = deque(maxlen=window)  # True for a failed call
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        """'call', 'trial' (the one half-open trial call) or None if the call is refused"""
+        with self._lock:
+            if self._opened_at is None:
+                return 'call'
+            if time.monotonic() - self._opened_at < self.cooldown or self._trial_running:
+                return None
+            self._trial_running = True
+            return 'trial'
+
+    def cancel_trial(self):
+        """Give up a half-open trial slot without recording a result"""
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, failed, trial=False):
+        with self._lock:
+            if trial:
+                self._trial_running = False
+                if failed:
+                    self._opened_at = time.monotonic()
+                else:
+                    self._opened_at = None
+                    self._results.clear()
+                return
+            if self._opened_at is not None:
+                return  # let through before the breaker opened, the trial decides now
+            self._results.append(failed)
+            if len(self._results) >= self.min_calls and sum(self._results) / len(self._results) >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+class OpenRouterClient:
+    def __init__(self, url, api_key, pool_size=10, max_retries=2, backoff=0.25,
+                 connect_timeout=3.05, max_in_flight=16, breaker=None, headers=None):
+        self.url = url
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.connect_timeout = connect_timeout
+        self.breaker = breaker or CircuitBreaker()
+        # Callers beyond this many concurrent requests fail fast instead of queueing up
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self._session = None  # made on the first call, so forked workers don't share its sockets
+
+        self.latency = {}      # endpoint -> Histogram
+        self.first_token = {}  # endpoint -> Histogram, streamed calls only
+        self.calls = {}    # (endpoint, status) -> count
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(self.headers)
+                self._session = session
+            return self._session
+
+    def _observe(self, endpoint, status, seconds=None):
+        """Count a call by status and, if it reached the network, time it"""
+        with self._lock:
+            histogram = self.latency.setdefault(endpoint, Histogram())
+            key = (endpoint, str(status))
+            self.calls[key] = self.calls.get(key, 0) + 1
+        if seconds is not None:
+            histogram.observe(seconds)
+
+    def _sleep_before_retry(self, attempt):
+        # Full jitter: anywhere between 0 and the exponential backoff
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def post(self, payload, endpoint='chat', timeout=10):
+        """POST a chat-completions payload and return the response.
+
+        Raises OpenRouterUnavailable if the breaker is open or too many calls are
+        in flight, and requests exceptions if every attempt failed.
+        """
+        trial = self._acquire(endpoint)
+        try:
+            return self._send(payload, endpoint, timeout, trial)
+        finally:
+            self._slots.release()
+
+    def _acquire(self, endpoint):
+        """Take an in-flight slot (and the breaker's trial, if half-open) or raise OpenRouterUnavailable.
+
+        Returns True if this call is the half-open trial.
+        """
+        allowed = self.breaker.allow()
+        if not allowed:
+            self._observe(endpoint, 'circuit_open')
+            raise OpenRouterUnavailable('OpenRouter circuit breaker is open')
+        if not self._slots.acquire(blocking=False):
+            self._observe(endpoint, 'overloaded')
+            if allowed == 'trial':
+                self.breaker.cancel_trial()
+            raise OpenRouterUnavailable('Too many OpenRouter calls in flight')
+        return allowed == 'trial'
+
+    def _send(self, payload, endpoint, timeout, trial=False, stream=False):
+        """Send the request with retries and tell the breaker how it went.
+
+        A successful stream isn't recorded here, it can still fail while it is
+        read; stream_chat() records it once it has been.
+        """
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        recorded = False
+        try:
+            attempt = 0
+            while True:
+                started = time.monotonic()
+                try:
+                    response = self.session.post(self.url, headers=headers, json=payload,
+                                                 timeout=(self.connect_timeout, timeout), stream=stream)
+                except requests.ConnectionError as e:
+                    # Including ConnectTimeout: the request never got there, so trying again is
+                    # cheap. A ReadTimeout isn't retried, an upstream that is stuck would hold
+                    # the calling thread for the full timeout on every attempt.
+                    self._observe(endpoint, type(e).__name__, time.monotonic() - started)
+                    if attempt < self.max_retries:
+                        self._sleep_before_retry(attempt)
+                        attempt += 1
+                        continue
+                    recorded = True
+                    self.breaker.record(True, trial)
+                    raise
+                except requests.RequestException as e:
+                    # Not worth retrying (read timeouts, bad URL or encoding errors), but still a failed call
+                    self._observe(endpoint, type(e).__name__, time.monotonic() - started)
+                    recorded = True
+                    self.breaker.record(True, trial)
+                    raise
+
+                self._observe(endpoint, response.status_code, time.monotonic() - started)
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    response.close()
+                    self._sleep_before_retry(attempt)
+                    attempt += 1
+                    continue
+
+                if stream and response.ok:
+                    recorded = True  # left to the caller
+                    return response
+                failed = response.status_code >= 500 or response.status_code == 429
+                recorded = True
+                self.breaker.record(failed, trial)
+                response.raise_for_status()
+                return response
+        finally:
+            if not recorded and trial:
+                # Whatever went wrong, a half-open trial must not stay taken forever
+                self.breaker.cancel_trial()
+
+    def chat(self, payload, endpoint='chat', timeout=10):
+        """POST a chat-completions payload and return the decoded JSON"""
+        return self.post(payload, endpoint=endpoint, timeout=timeout).json()
+
+    def stream_chat(self, payload, endpoint='chat_stream', timeout=15):
+        """Yield the content of a streamed chat completion piece by piece as it arrives.
+
+        The call keeps its in-flight slot until the stream is closed, so
+        max_in_flight bounds open streams too. Chunks that aren't valid JSON are
+        skipped; the connection breaking mid-answer counts as a failed call.
+        """
+        started = time.monotonic()
+        trial = self._acquire(endpoint)
+        failed = None  # unknown until the stream is read to the end or breaks
+        try:
+            with self._send(dict(payload, stream=True), endpoint, timeout, trial, stream=True) as response:
+                first = True
+                try:
+                    # chunk_size=None hands over each chunk as soon as it arrives
+                    for line in response.iter_lines(chunk_size=None):
+                        # Skip keep-alive comments (": OPENROUTER PROCESSING") and blank separators
+                        if not line.startswith(b'data:'):
+                            continue
+                        data = line[5:].strip()
+                        if data == b'[DONE]':
+                            break
+                        try:
+                            delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                        except (ValueError, LookupError, TypeError, AttributeError):
+                            self._observe(endpoint, 'bad_chunk')
+                            continue
+                        if not delta:
+                            continue
+                        if first:
+                            first = False
+                            with self._lock:
+                                histogram = self.first_token.setdefault(endpoint, Histogram())
+                            histogram.observe(time.monotonic() - started)
+                        yield delta
+                except requests.RequestException as e:
+                    self._observe(endpoint, type(e).__name__)
+                    failed = True
+                    raise
+                failed = False
+        finally:
+            if failed is not None:
+                self.breaker.record(failed, trial)
+            elif trial:
+                self.breaker.cancel_trial()  # not sent, or closed by the reader before the end
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            calls = {}
+            for (endpoint, status), count in self.calls.items():
+                calls.setdefault(endpoint, {})[status] = count
+            latency = {endpoint: histogram.summary() for endpoint, histogram in self.latency.items()}
+            first_token = {endpoint: histogram.summary() for endpoint, histogram in self.first_token.items()}
+        return {'breaker': self.breaker.state, 'calls': calls, 'latency_seconds': latency,
+                'time_to_first_token_seconds': first_token}
+
+    def export(self, out, prefix='openrouter'):
+        """Add the call counts and latencies to a metrics.PrometheusText"""
+        with self._lock:
+            calls = sorted(self.calls.items())
+            latency = sorted(self.latency.items())
+            first_token = sorted(self.first_token.items())
+        for (endpoint, status), count in calls:
+            out.counter(f'{prefix}_calls_total', count, 'OpenRouter calls by outcome', endpoint=endpoint, status=status)
+        for endpoint, histogram in latency:
+            out.histogram(f'{prefix}_call_duration_seconds', histogram, 'OpenRouter call latency', endpoint=endpoint)
+        for endpoint, histogram in first_token:
+            out.histogram(f'{prefix}_first_token_seconds', histogram, 'Time to the first streamed token',
+                          endpoint=endpoint)
+        current = self.breaker.state
+        for state in ('closed', 'open', 'half-open'):
+            out.gauge(f'{prefix}_breaker_state', current == state, 'Circuit breaker state', state=state)
@@ -0,0 +1,176 @@
+"""Password hashing off the request threads, and a limiter for failed logins.
+
+Hashing is deliberately slow, so when a whole school logs in at once it is the
+CPU, not the database, that runs out. PasswordHasher runs the hashes in a small
+process pool, so they don't hold the GIL the request threads need, and caps how
+many may wait for it. Past the cap, logins are turned away straight away with
+HasherBusy instead of piling up behind each other until everything times out.
+
+The hash parameters are configurable. Stored hashes made with other parameters
+still verify, and needs_rehash() tells the login to upgrade them.
+"""
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from metrics import Histogram
+
+
+def hash_parameters(method):
+    """A werkzeug hash method ('scrypt:32768:8:1', 'pbkdf2:sha256') as comparable parameters.
+
+    Parameters left out get werkzeug's defaults, so 'scrypt' and 'scrypt:32768:8:1'
+    come out the same. Methods werkzeug doesn't take arguments for are kept as given.
+    """
+    name, *args = method.lower().split(':')
+    if name == 'scrypt':
+        if not args:
+            return ('scrypt', 2 ** 15, 8, 1)
+        try:
+            n, r, p = map(int, args)
+        except ValueError:
+            return (name, *args)
+        return ('scrypt', n, r, p)
+    if name == 'pbkdf2':
+        # The hash name and iteration count are told apart by what they look like, not position
+        iterations = [arg for arg in args if arg.isdigit()]
+        hash_names = [arg for arg in args if not arg.isdigit()]
+        if len(iterations) > 1 or len(hash_names) > 1:
+            return (name, *args)
+        return ('pbkdf2', hash_names[0] if hash_names else 'sha256',
+                int(iterations[0]) if iterations else DEFAULT_PBKDF2_ITERATIONS)
+    return (name, *args)
+
+
+class HasherBusy(Exception):
+    """Too many hashes are already waiting for the pool"""
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt:32768:8:1', workers=2, max_pending=32, timeout=30):
+        self.method = method
+        self.workers = workers      # 0 hashes in the calling thread
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.hash_time = Histogram()
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with other parameters than the configured ones"""
+        return hash_parameters(password_hash.split('$', 1)[0]) != hash_parameters(self.method)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy()
+        started = time.monotonic()
+        try:
+            if not self.workers:
+                return fn(*args)
+            try:
+                return self._executor().submit(fn, *args).result(timeout=self.timeout)
+            except TimeoutError:
+                raise HasherBusy()
+        finally:
+            self._slots.release()
+            self.hash_time.observe(time.monotonic() - started)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # Not fork: the workers would inherit the app's threads and locks mid-use
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def stats(self):
+        return {
+            'method': self.method.split(':', 1)[0],
+            'workers': self.workers,
+            'rejected': self.rejected,
+            'hash_time': self.hash_time.summary(),
+        }
+
+
+class LoginLimiter:
+    """Counts failed logins per key (an account, an IP) in a sliding window.
+
+    A kind listed in `distinct` counts the different values of another kind
+    instead of every failure: with distinct={'ip': 'account'} an address is
+    limited on how many accounts failed from it, so a school behind one NAT
+    address isn't locked out by students mistyping their own passwords, while
+    someone trying passwords across many accounts still is.
+
+    Counts are kept per process, so with several workers the effective limit is
+    up to that many times higher.
+    """
+
+    def __init__(self, limits, distinct=None, max_keys=10000):
+        self.limits = limits  # kind -> (max failures, window in seconds)
+        self.distinct = distinct or {}  # kind -> kind whose different values are counted
+        self.max_keys = max_keys
+        self._failures = {}  # (kind, key) -> (time, counted value) pairs, oldest first
+        self._lock = threading.Lock()
+        self.blocked = 0
+
+    def retry_after(self, **keys):
+        """Seconds until any of these keys may try again, 0 if none is blocked"""
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for kind, key in keys.items():
+                limit, window = self.limits[kind]
+                failures = self._prune((kind, key), now - window)
+                if len(failures) >= limit:
+                    # Blocked until enough of them have aged out of the window
+                    wait = max(wait, failures[len(failures) - limit][0] + window - now)
+            if wait:
+                self.blocked += 1
+        return int(wait) + 1 if wait else 0
+
+    def failed(self, **keys):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._failures) >= self.max_keys:
+                # Someone is cycling through addresses or emails, forget what has expired
+                for kind, key in list(self._failures):
+                    self._prune((kind, key), now - self.limits[kind][1])
+            for kind, key in keys.items():
+                self._prune((kind, key), now - self.limits[kind][1])
+                failures = self._failures.setdefault((kind, key), deque())
+                value = keys.get(self.distinct[kind]) if kind in self.distinct else None
+                if value is not None:
+                    # One entry per value, the latest
+                    for entry in failures:
+                        if entry[1] == value:
+                            failures.remove(entry)
+                            break
+                failures.append((now, value))
+
+    def reset(self, **keys):
+        with self._lock:
+            for kind, key in keys.items():
+                self._failures.pop((kind, key), None)
+
+    def _prune(self, key, cutoff):
+        failures = self._failures.get(key)
+        if failures is None:
+            return ()
+        while failures and failures[0][0] <= cutoff:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+        return failures
@@ -0,0 +1,81 @@
+"""Full-text search over posts, comments and users with SQLite FTS5.
+
+Each searchable table gets an external-content FTS5 index that triggers keep in
+step with the table, so every write (ORM, bulk queries, other processes) updates
+the index in its own transaction. The indexes hold only the terms; snippets are
+built from the original rows.
+"""
+import html
+import re
+
+# table -> (FTS table, indexed columns, bm25 weight per column)
+INDEXES = {
+    'post': ('post_fts', ['title', 'description'], [2.0, 1.0]),
+    'comment': ('comment_fts', ['content'], [1.0]),
+    'user': ('user_fts', ['username', 'full_name'], [2.0, 1.0]),
+}
+MAX_TERMS = 8
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+def install(connection):
+    """Create missing FTS indexes and their triggers, filling new indexes from the table.
+
+    Returns the names of the indexes that were created.
+    """
+    created = []
+    for table, (fts, columns, _) in INDEXES.items():
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).first()
+        cols = ', '.join(columns)
+        new_cols = ', '.join(f'new.{column}' for column in columns)
+        old_cols = ', '.join(f'old.{column}' for column in columns)
+        if not exists:
+            connection.exec_driver_sql(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5({cols}, content='{table}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+            connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            created.append(fts)
+        connection.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON "{table}" BEGIN '
+            f'INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END')
+        connection.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON "{table}" BEGIN '
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END")
+        # Only the indexed columns, status changes and the like don't touch the index
+        connection.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON "{table}" BEGIN '
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); "
+            f'INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END')
+    return created
+
+
+def match_query(text):
+    """FTS5 MATCH expression for what someone typed: every word, each as a prefix.
+
+    Returns None if there is nothing to search for. Words are quoted, so FTS5
+    operators in the input are treated as plain text.
+    """
+    terms = re.findall(r'\w+', text.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and turn the match markers into <mark> tags"""
+    return html.escape(snippet or '').replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search(connection, table, query, limit, offset=0, where=''):
+    """Ranked matches in one table as (id, snippet) rows, best first.
+
+    `where` is an extra SQL condition on the original table (aliased `t`).
+    """
+    fts, columns, weights = INDEXES[table]
+    weight_args = ', '.join(str(weight) for weight in weights)
+    sql = (f'SELECT t.id, snippet({fts}, -1, ?, ?, ?, 12) FROM {fts} '
+           f'JOIN "{table}" t ON t.id = {fts}.rowid '
+           f'WHERE {fts} MATCH ? {"AND " + where if where else ""} '
+           f'ORDER BY bm25({fts}, {weight_args}) LIMIT ? OFFSET ?')
+    return connection.exec_driver_sql(sql, (MARK_START, MARK_END, '…', query, limit, offset)).all()
@@ -0,0 +1,171 @@
+"""Content-addressed storage for uploads.
+
+Each distinct file is stored once as `ab/cd/<sha256><ext>` under the upload
+folder, so identical uploads share one copy and no directory grows too large.
+Reference counts live in the database (MediaBlob in app.py); this module only
+deals with the files.
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import time
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of each image type we accept, and the extension to store it under
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+]
+SNIFF_BYTES = 12  # enough for every signature, WebP is "RIFF" <size> "WEBP"
+
+
+class UnsupportedUpload(Exception):
+    """Raised when an upload's content isn't one of the accepted image types"""
+
+
+def sniff_image(head):
+    """Extension for the image type these leading bytes belong to, or None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+class TempUpload:
+    """Writable temp file that hashes and sniffs an upload as it streams in.
+
+    The form parser writes each file part straight into one of these, so a bad
+    file is rejected after its first few bytes and nothing is held in memory.
+    """
+
+    def __init__(self, path, fd):
+        self.path = path
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self.size = 0
+        self.extension = None
+
+    def write(self, data):
+        if self.extension is None:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self._sniff()
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def _sniff(self):
+        self.extension = sniff_image(self._head)
+        if self.extension is None:
+            raise UnsupportedUpload('Upload is not a PNG, JPEG, GIF or WebP image')
+
+    def __getattr__(self, name):
+        # read/seek/tell/... for werkzeug's FileStorage
+        return getattr(self._file, name)
+
+    def finish(self):
+        """Close the file and hand it over as (sha256, size, temp_path, ext)"""
+        if self.extension is None:
+            self._sniff()  # shorter than SNIFF_BYTES
+        self._file.close()
+        path, self.path = self.path, None
+        return self._digest.hexdigest(), self.size, path, self.extension
+
+    def discard(self):
+        """Remove the temp file unless finish() handed it over"""
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, '.tmp')
+
+    @staticmethod
+    def relpath(sha256, ext):
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+    def open_temp(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        return TempUpload(temp_path, fd)
+
+    def write_temp(self, stream):
+        """Copy a stream to a temp file in chunks, hashing it on the way.
+
+        Returns (sha256, size, temp_path).
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        return digest.hexdigest(), size, temp_path
+
+    def commit(self, temp_path, sha256, ext):
+        """Move a temp file to its content address and return the relative path"""
+        rel = self.relpath(sha256, ext)
+        dest = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(temp_path, dest)  # atomic, and harmless if the same content is already there
+        return rel
+
+    def discard(self, temp_path):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, rel):
+        """Delete a stored file along with anything derived from it (`<sha256>.*`, e.g. resized copies)"""
+        path = os.path.join(self.root, rel)
+        stem = os.path.splitext(path)[0]
+        for name in [path] + glob.glob(glob.escape(stem) + '.*'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def stored_paths(self):
+        """Relative paths of every stored original (derived files are skipped)"""
+        for shard in glob.glob(os.path.join(self.root, '[0-9a-f][0-9a-f]', '[0-9a-f][0-9a-f]')):
+            for name in os.listdir(shard):
+                if name.count('.') <= 1:
+                    yield os.path.relpath(os.path.join(shard, name), self.root).replace(os.sep, '/')
+
+    def clean_temp(self, older_than=3600):
+        """Remove temp files left behind by interrupted uploads"""
+        if not os.path.isdir(self.tmp_dir):
+            return 0
+        removed = 0
+        cutoff = time.time() - older_than
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            if os.path.getmtime(path) < cutoff:
+                self.discard(path)
+                removed += 1
+        return removed
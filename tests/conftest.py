@@ -0,0 +1,60 @@
+"""Test setup: the app runs against a throwaway SQLite database, without an OpenRouter key."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+TEST_DIR = tempfile.mkdtemp(prefix='schoolnet-tests-')
+
+# Set before the app is imported; load_dotenv() doesn't override them
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TEST_DIR, 'school_app.db')}",
+    'MODERATION_CACHE_DB': os.path.join(TEST_DIR, 'moderation_cache.db'),
+    'OPENROUTER_API_KEY': '',
+    'OPENROUTE_API_KEY': '',
+    'PASSWORD_HASH_WORKERS': '0',
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    'REQUEST_LOG': '0',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as schoolnet  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    schoolnet.app.config['TESTING'] = True
+    with schoolnet.app.app_context():
+        schoolnet.prepare_app()
+    yield schoolnet.app
+    with schoolnet.app.app_context():
+        db = schoolnet.db
+        for table in reversed(db.metadata.sorted_tables):
+            if table.name != schoolnet.FeedState.__tablename__:
+                db.session.execute(table.delete())
+        db.session.execute(schoolnet.BUMP_FEED_VERSION)
+        db.session.commit()
+    schoolnet.user_cache._entries.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(email, role='student', password='password'):
+    """Create a user (call inside an app context)"""
+    user = schoolnet.User(email=email, username=email.split('@')[0], role=role)
+    user.set_password(password)
+    schoolnet.db.session.add(user)
+    schoolnet.db.session.commit()
+    return user
+
+
+def log_in(client, email, role='student'):
+    with client.application.app_context():
+        make_user(email, role)
+    response = client.post('/login', data={'email': email, 'password': 'password'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,83 @@
+import time
+from datetime import datetime, timedelta
+
+import app as schoolnet
+from conftest import log_in
+
+
+def announce(client, content, starts_at=None):
+    data = {'content': content}
+    if starts_at:
+        data['starts_at'] = starts_at.isoformat(timespec='minutes')
+    assert client.post('/add_announcement', data=data).status_code == 302
+
+
+def feed_descriptions(client):
+    return [post['description'] for post in client.get('/api/feed').get_json()['posts']]
+
+
+def test_new_pin_retires_the_previous_one(app, client):
+    log_in(client, 'teacher@school', role='teacher')
+    announce(client, 'First')
+    announce(client, 'Second')
+
+    with app.app_context():
+        pins = schoolnet.PinnedAnnouncement.query.order_by(schoolnet.PinnedAnnouncement.id).all()
+        assert pins[0].expires_at is not None and pins[0].expires_at <= datetime.now()
+        assert pins[1].expires_at is None
+        assert schoolnet.current_pin().post.description == 'Second'
+
+
+def test_scheduled_pin_retires_the_current_one_when_it_starts(app, client):
+    log_in(client, 'teacher@school', role='teacher')
+    announce(client, 'Now')
+    starts_at = (datetime.now() + timedelta(days=1)).replace(second=0, microsecond=0)
+    announce(client, 'Tomorrow', starts_at)
+
+    with app.app_context():
+        assert schoolnet.current_pin().post.description == 'Now'
+        later = schoolnet.current_pin(starts_at + timedelta(minutes=1))
+        assert later.post.description == 'Tomorrow'
+        now_pin = schoolnet.PinnedAnnouncement.query.order_by(schoolnet.PinnedAnnouncement.id).first()
+        assert now_pin.expires_at == starts_at
+
+
+def test_scheduled_announcement_stays_out_of_the_feed(app, client):
+    log_in(client, 'teacher@school', role='teacher')
+    starts_at = datetime.now() + timedelta(days=1)
+    announce(client, 'Tomorrow', starts_at)
+    announce(client, 'Today')
+
+    assert feed_descriptions(client) == ['Today']
+    assert 'Tomorrow' not in client.get('/').get_data(as_text=True)
+    assert client.get('/api/search?q=tomorrow&type=posts').get_json()['results']['posts'] == []
+    assert len(client.get('/api/search?q=today&type=posts').get_json()['results']['posts']) == 1
+    with app.app_context():
+        posts, _ = schoolnet.feed_page(now=starts_at + timedelta(minutes=1))
+        assert [post.description for post in posts] == ['Tomorrow', 'Today']
+
+
+def test_cached_feed_page_expires_when_a_scheduled_announcement_starts(app, client):
+    log_in(client, 'teacher@school', role='teacher')
+    starts_at = (datetime.now() + timedelta(days=1)).replace(second=0, microsecond=0)
+    announce(client, 'Tomorrow', starts_at)
+
+    with app.test_request_context():
+        schoolnet.first_feed_page()
+        entry = schoolnet.feed_cache._entries['first_page']
+    assert entry[1] == starts_at
+
+
+def test_announcement_is_dated_in_utc_like_other_posts(app, client, monkeypatch):
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    try:
+        log_in(client, 'teacher@school', role='teacher')
+        announce(client, 'Announcement')
+        with app.app_context():
+            schoolnet.db.session.add(schoolnet.Post(post_key='later', description='Later', author='teacher@school'))
+            schoolnet.db.session.commit()
+        assert feed_descriptions(client) == ['Later', 'Announcement']
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,35 @@
+import pytest
+
+from answer_cache import AnswerCache
+
+
+@pytest.fixture
+def cache():
+    cache = AnswerCache()
+    cache.put('How do I convert Fahrenheit to Celsius?', 'Subtract 32, then multiply by 5/9.')
+    cache.put('What is 12 divided by 4?', '3')
+    cache.put('What is photosynthesis?', 'How plants make food from light.')
+    return cache
+
+
+def test_the_same_question_is_a_hit(cache):
+    assert cache.get('what is 12 divided by 4') == '3'
+    assert cache.get('WHAT IS PHOTOSYNTHESIS!!') == 'How plants make food from light.'
+
+
+def test_a_question_reworded_with_filler_is_a_hit(cache):
+    assert cache.get('Can you please explain photosynthesis') == 'How plants make food from light.'
+    assert cache.get('12 divided by 4?') == '3'
+
+
+@pytest.mark.parametrize('question', [
+    'How do I convert Celsius to Fahrenheit?',
+    'What is 4 divided by 12?',
+    'What is 12 divided by 3?',
+    'What is 12 multiplied by 4?',
+    'What is 1 divided by 24?',
+    'How do I convert Fahrenheit to Kelvin?',
+    'Why is photosynthesis important?',
+])
+def test_reordered_or_different_questions_miss(cache, question):
+    assert cache.get(question) is None
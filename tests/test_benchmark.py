@@ -0,0 +1,9 @@
+import benchmark
+
+
+def test_print_results_shows_missing_numbers_as_dashes(capsys):
+    results = {'scenarios': {'feed': {'throughput_rps': None, 'p50_ms': None, 'p99_ms': None, 'errors': 5}}}
+    previous = {'scenarios': {'feed': {'throughput_rps': 10.0, 'p50_ms': 5.0, 'p99_ms': 9.0}}}
+    benchmark.print_results(results, previous)
+    line = capsys.readouterr().out.splitlines()[1]
+    assert line.split() == ['feed', '-', '-', '-', '5']
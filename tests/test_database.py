@@ -0,0 +1,31 @@
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+from database import QueryTimer
+
+
+def test_failed_statement_does_not_leave_its_start_time():
+    engine = create_engine('sqlite://')
+    timer = QueryTimer()
+    timer.install(engine)
+
+    with engine.connect() as conn:
+        with pytest.raises(exc.OperationalError):
+            conn.execute(text('SELECT * FROM missing_table'))
+        assert conn.info['query_started'] == {}
+
+        conn.execute(text('SELECT 1'))
+        assert conn.info['query_started'] == {}
+    assert [s['statement'] for s in timer.stats()['top_statements']] == ['SELECT 1']
+
+
+def test_slow_queries_go_to_the_log_callback():
+    engine = create_engine('sqlite://')
+    logged = []
+    timer = QueryTimer(slow_seconds=0, log=lambda event, level='info', **fields: logged.append((event, level, fields)))
+    timer.install(engine)
+
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    assert [(event, level, fields['statement']) for event, level, fields in logged] == [
+        ('slow_query', 'warning', 'SELECT 1')]
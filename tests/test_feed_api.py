@@ -0,0 +1,31 @@
+import app as schoolnet
+from conftest import log_in, make_user
+
+
+def seed_post_with_comment(app):
+    db = schoolnet.db
+    with app.app_context():
+        author = make_user('writer@school')
+        db.session.add(schoolnet.Post(post_key='p1', description='Exam on Monday', author=author.email))
+        db.session.add(schoolnet.Comment(content='Which room?', post_id='p1', author_id=author.id))
+        db.session.commit()
+
+
+def test_anonymous_feed_has_posts_but_no_comments_or_emails(app, client):
+    seed_post_with_comment(app)
+    for url in ('/api/feed', '/api/feed?limit=5'):
+        response = client.get(url)
+        [post] = response.get_json()['posts']
+        assert post['description'] == 'Exam on Monday'
+        assert post['author'] == 'writer'
+        assert post['comments'] == [] and post['comments_cursor'] is None
+        assert b'writer@school' not in response.data
+
+
+def test_logged_in_feed_has_comment_previews_without_emails(app, client):
+    seed_post_with_comment(app)
+    log_in(client, 'reader@school')
+    response = client.get('/api/feed')
+    [post] = response.get_json()['posts']
+    assert post['author'] == 'writer'
+    assert [comment['content'] for comment in post['comments']] == ['Which room?']
@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import app as schoolnet
+from conftest import log_in
+
+
+@contextmanager
+def count_statements(app):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = schoolnet.db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def seed_posts(app, count, comments_per_post=4):
+    """Add posts by different authors, each with comments by different users"""
+    db = schoolnet.db
+    with app.app_context():
+        start = schoolnet.Post.query.count()
+        for i in range(start, start + count):
+            author = schoolnet.User(email=f'author{i}@school', username=f'author{i}', role='student', password_hash='x')
+            db.session.add(author)
+            db.session.add(schoolnet.Post(post_key=f'post_{i}', description=f'Post {i}', author=author.email))
+            db.session.flush()
+            for j in range(comments_per_post):
+                commenter = schoolnet.User(email=f'reader{i}_{j}@school', username=f'reader{i}_{j}', password_hash='x')
+                db.session.add(commenter)
+                db.session.flush()
+                db.session.add(schoolnet.Comment(content=f'Comment {j}', post_id=f'post_{i}', author_id=commenter.id))
+        db.session.commit()
+
+
+def test_home_page_queries_do_not_grow_with_posts_and_comments(app, client):
+    log_in(client, 'viewer@school')
+    client.get('/')  # loads the logged-in user into the user cache
+
+    seed_posts(app, 2)
+    with count_statements(app) as few:
+        assert client.get('/').status_code == 200
+
+    seed_posts(app, 15)
+    with count_statements(app) as many:
+        response = client.get('/')
+    assert response.status_code == 200
+    assert b'Post 16' in response.data and b'Comment 3' in response.data
+
+    assert len(many) == len(few), many
+
+
+def test_comments_api_queries_do_not_grow_with_comments(app, client):
+    log_in(client, 'viewer@school')
+    client.get('/')  # loads the logged-in user into the user cache
+
+    seed_posts(app, 1, comments_per_post=2)
+    with count_statements(app) as few:
+        assert len(client.get('/api/comments/post_0').get_json()['comments']) == 2
+
+    seed_posts(app, 1, comments_per_post=15)
+    with count_statements(app) as many:
+        assert len(client.get('/api/comments/post_1').get_json()['comments']) == 15
+
+    assert len(many) == len(few), many
@@ -0,0 +1,24 @@
+import json
+import time
+from datetime import datetime
+
+import app as schoolnet
+
+
+def test_legacy_timestamps_are_imported_in_utc(app, tmp_path, monkeypatch):
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    try:
+        feeds = tmp_path / 'feeds.json'
+        feeds.write_text(json.dumps([
+            {'id': 'announcement_20240102_093000_123456', 'content': 'Assembly moved', 'type': 'announcement'},
+            {'id': '2024-01-02T09:00:00.000001', 'description': 'Morning post', 'type': 'text'},
+        ]))
+        with app.app_context():
+            assert schoolnet.import_feeds_file(str(feeds)) == 2
+            created = dict(schoolnet.db.session.query(schoolnet.Post.description, schoolnet.Post.created_at))
+        assert created['Morning post'] == datetime(2024, 1, 2, 3, 30, 0, 1)
+        assert created['Assembly moved'] == datetime(2024, 1, 2, 4, 0)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,44 @@
+import json
+
+import app as schoolnet
+from conftest import log_in
+from live import LiveHub
+
+
+def test_live_stream_requires_login(client):
+    response = client.get('/api/live')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+
+
+def test_live_stream_refused_above_cap(app, client, monkeypatch):
+    monkeypatch.setattr(schoolnet, 'live_hub', LiveHub(max_clients=1))
+    log_in(client, 'viewer@school')
+
+    first = client.get('/api/live')
+    assert first.status_code == 200
+    second = client.get('/api/live')
+    assert second.status_code == 503
+    assert second.headers['Retry-After'] == str(schoolnet.LIVE_RETRY_AFTER)
+
+    first.close()  # ends the first stream, which frees its place
+    assert schoolnet.live_hub.stats()['clients'] == 0
+    third = client.get('/api/live')
+    assert third.status_code == 200
+    third.close()
+
+
+def test_published_comment_has_no_email(app, client, monkeypatch):
+    hub = LiveHub()
+    monkeypatch.setattr(schoolnet, 'live_hub', hub)
+    log_in(client, 'writer@school')
+    with app.app_context():
+        schoolnet.db.session.add(schoolnet.Post(post_key='post_1', description='Hello', author='writer@school'))
+        schoolnet.db.session.commit()
+
+    subscription = hub.subscribe()
+    client.post('/add_comment', data={'post_id': 'post_1', 'content': 'Nice post'})
+    event_id, event, data = subscription.messages.get(timeout=1)
+    assert event == 'comment_added'
+    assert 'writer@school' not in data
+    assert json.loads(data)['comment']['author'] == 'writer'
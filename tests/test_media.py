@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+import media
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def test_srcset_uses_the_widths_the_variants_really_have(tmp_path):
+    Image.new('RGB', (500, 1200)).save(tmp_path / 'portrait.jpg')
+    media.make_image_variants(str(tmp_path), 'portrait.jpg')
+
+    entries = media.srcset_entries(str(tmp_path), 'portrait.jpg')
+    assert entries == [('portrait.avatar.webp', 40), ('portrait.feed.webp', 300), ('portrait.full.webp', 500)]
+    for name, width in entries:
+        with Image.open(tmp_path / name) as variant:
+            assert variant.width == width
+
+
+def test_small_images_are_not_upscaled(tmp_path):
+    Image.new('RGB', (200, 150)).save(tmp_path / 'small.png')
+    assert media.make_image_variants(str(tmp_path), 'small.png') == {'avatar': 96, 'feed': 200}
+    assert not os.path.exists(tmp_path / 'small.full.webp')
+    assert media.pick_variant(str(tmp_path), 'small.png', 'full') == 'small.feed.webp'
@@ -0,0 +1,117 @@
+import time
+
+import pytest
+import requests
+
+from openrouter import CircuitBreaker, OpenRouterClient, OpenRouterUnavailable
+
+
+class FakeSession:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+
+    def post(self, url, **kwargs):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def half_open_client(*outcomes):
+    breaker = CircuitBreaker(min_calls=1, cooldown=0.01)
+    breaker.record(True)
+    time.sleep(0.02)
+    client = OpenRouterClient('http://openrouter.invalid/chat', 'key', max_retries=0, breaker=breaker)
+    client._session = FakeSession(*outcomes)
+    return client
+
+
+@pytest.mark.parametrize('error', [requests.exceptions.ChunkedEncodingError(), requests.exceptions.InvalidURL(),
+                                   requests.exceptions.SSLError(), ValueError('not from requests at all')])
+def test_any_error_in_a_half_open_trial_frees_the_trial(error):
+    client = half_open_client(error)
+    assert client.breaker.state == 'half-open'
+    with pytest.raises(type(error)):
+        client.post({'messages': []})
+    # Either recorded as a failure (open again, retried after the cooldown) or the trial was given up
+    time.sleep(0.02)
+    assert client.breaker.allow()
+
+
+class FakeStream:
+    status_code = 200
+    ok = True
+
+    def __init__(self, *lines, error=None):
+        self.lines = lines
+        self.error = error
+
+    def iter_lines(self, chunk_size=None):
+        yield from self.lines
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def test_a_stream_holds_its_slot_until_it_is_closed():
+    client = OpenRouterClient('http://openrouter.invalid/chat', 'key', max_in_flight=1)
+    client._session = FakeSession(FakeStream(b'data: {"choices": [{"delta": {"content": "Hi"}}]}', b'data: [DONE]'))
+    stream = client.stream_chat({'messages': []})
+    assert next(stream) == 'Hi'
+    with pytest.raises(OpenRouterUnavailable):
+        client.post({'messages': []})  # the open stream still has the only slot
+    stream.close()
+    assert client._slots.acquire(blocking=False)
+
+
+def test_bad_chunks_are_skipped_and_a_broken_stream_counts_as_a_failure():
+    breaker = CircuitBreaker(min_calls=1)
+    client = OpenRouterClient('http://openrouter.invalid/chat', 'key', breaker=breaker)
+    client._session = FakeSession(FakeStream(b'data: {not json', b'data: {"choices": [{"delta": {"content": "Hi"}}]}',
+                                             error=requests.exceptions.ChunkedEncodingError()))
+    tokens = []
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        for token in client.stream_chat({'messages': []}):
+            tokens.append(token)
+    assert tokens == ['Hi']
+    assert breaker.state == 'open'
+    assert client.stats()['calls']['chat_stream']['bad_chunk'] == 1
+
+
+def test_a_late_result_from_before_the_breaker_opened_does_not_close_it():
+    breaker = CircuitBreaker(min_calls=5, cooldown=0.01)
+    late = breaker.allow()
+    for _ in range(5):
+        breaker.record(True, breaker.allow() == 'trial')
+    assert breaker.state == 'open'
+
+    breaker.record(False, late == 'trial')  # admitted while closed, finished after it opened
+    time.sleep(0.02)
+    assert breaker.state == 'half-open'
+
+    assert breaker.allow() == 'trial'
+    breaker.record(False, late == 'trial')  # still not the trial's result
+    assert breaker.state == 'half-open' and breaker.allow() is None
+    breaker.record(False, trial=True)
+    assert breaker.state == 'closed'
+
+
+def test_connect_errors_are_retried_but_read_timeouts_are_not(monkeypatch):
+    monkeypatch.setattr(OpenRouterClient, '_sleep_before_retry', lambda self, attempt: None)
+    ok = requests.Response()
+    ok.status_code, ok._content = 200, b'{"choices": []}'
+
+    client = OpenRouterClient('http://openrouter.invalid/chat', 'key', max_retries=2)
+    client._session = FakeSession(requests.exceptions.ConnectTimeout(), requests.exceptions.ConnectionError(), ok)
+    assert client.chat({'messages': []}) == {'choices': []}
+
+    client = OpenRouterClient('http://openrouter.invalid/chat', 'key', max_retries=2)
+    client._session = FakeSession(requests.exceptions.ReadTimeout(), ok)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.chat({'messages': []})
+    assert client._session.outcomes == [ok]
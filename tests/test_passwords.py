@@ -0,0 +1,47 @@
+from werkzeug.security import generate_password_hash
+
+from passwords import LoginLimiter, PasswordHasher
+
+
+def test_needs_rehash_compares_parameters_not_strings():
+    hasher = PasswordHasher('scrypt', workers=0)
+    assert not hasher.needs_rehash('scrypt:32768:8:1$salt$hash')
+    assert hasher.needs_rehash('scrypt:16384:8:1$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha256:600000$salt$hash')
+
+    hasher = PasswordHasher('pbkdf2:sha256:600000', workers=0)
+    assert not hasher.needs_rehash('pbkdf2:600000:sha256$salt$hash')
+    assert not hasher.needs_rehash('PBKDF2:SHA256:600000$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha256:260000$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha512:600000$salt$hash')
+    assert hasher.needs_rehash('scrypt:32768:8:1$salt$hash')
+
+
+def test_fresh_hash_does_not_need_rehash():
+    for method in ('scrypt', 'scrypt:16384:8:1', 'pbkdf2', 'pbkdf2:sha256', 'pbkdf2:sha256:1000'):
+        hasher = PasswordHasher(method, workers=0)
+        assert not hasher.needs_rehash(generate_password_hash('secret', method)), method
+
+
+def test_ip_limit_counts_accounts_not_attempts():
+    limiter = LoginLimiter({'account': (5, 900), 'ip': (3, 300)}, distinct={'ip': 'account'})
+    # A school behind one address: students mistyping their own passwords
+    for student in ('ann', 'bob'):
+        for _ in range(4):
+            limiter.failed(account=student, ip='10.0.0.1')
+    assert limiter.retry_after(account='cat', ip='10.0.0.1') == 0
+
+    # The same address failing on a third account in the window is someone spraying passwords
+    limiter.failed(account='dan', ip='10.0.0.1')
+    assert limiter.retry_after(account='cat', ip='10.0.0.1') > 0
+    assert limiter.retry_after(account='cat', ip='10.0.0.2') == 0
+
+
+def test_account_limit_blocks_until_the_oldest_failure_expires():
+    limiter = LoginLimiter({'account': (2, 60)})
+    limiter.failed(account='ann')
+    assert limiter.retry_after(account='ann') == 0
+    limiter.failed(account='ann')
+    assert 0 < limiter.retry_after(account='ann') <= 61
+    limiter.reset(account='ann')
+    assert limiter.retry_after(account='ann') == 0
@@ -0,0 +1,92 @@
+import io
+import os
+import sqlite3
+
+import pytest
+
+import app as schoolnet
+from storage import BlobStore
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(schoolnet, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr(schoolnet, 'blob_store', BlobStore(str(tmp_path)))
+    return tmp_path
+
+
+def png_upload(name):
+    data = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(data, 'PNG')
+    data.seek(0)
+    return schoolnet.FileStorage(data, filename=name)
+
+
+def ref_count(path):
+    return schoolnet.MediaBlob.query.filter_by(path=path).one().ref_count
+
+
+def test_identical_uploads_share_one_file(app, upload_folder):
+    with app.test_request_context():
+        first = schoolnet.store_upload(png_upload('a.png'), '.png')
+        second = schoolnet.store_upload(png_upload('b.png'), '.png')
+        schoolnet.db.session.commit()
+        assert first == second and ref_count(first) == 2
+
+        assert schoolnet.release_upload(first) is None
+        schoolnet.db.session.commit()
+        assert ref_count(first) == 1 and os.path.isfile(upload_folder / first)
+
+
+def test_a_file_stored_again_before_its_release_removes_it_is_kept(app, upload_folder):
+    with app.test_request_context():
+        path = schoolnet.store_upload(png_upload('a.png'), '.png')
+        schoolnet.db.session.commit()
+        orphan = schoolnet.release_upload(path)
+        schoolnet.db.session.commit()
+        assert orphan == path
+
+        # The same image is uploaded again before the release gets to delete the file
+        again = schoolnet.store_upload(png_upload('b.png'), '.png')
+        schoolnet.db.session.commit()
+        schoolnet.remove_orphaned_upload(orphan)
+
+        assert again == path and ref_count(path) == 1
+        assert os.path.isfile(upload_folder / path)
+        assert os.path.isfile(upload_folder / schoolnet.widths_name(path))
+
+
+def test_a_released_file_nobody_took_is_removed(app, upload_folder):
+    with app.test_request_context():
+        path = schoolnet.store_upload(png_upload('a.png'), '.png')
+        schoolnet.db.session.commit()
+        orphan = schoolnet.release_upload(path)
+        schoolnet.db.session.commit()
+        schoolnet.remove_orphaned_upload(orphan)
+        assert not os.listdir(upload_folder / path.rsplit('/', 1)[0])
+
+
+def test_resizing_does_not_hold_the_write_lock(app, upload_folder, monkeypatch):
+    database = os.environ['DATABASE_URL'].split(':///', 1)[1]
+    blocked = []
+
+    process_uploaded_image = schoolnet.process_uploaded_image
+
+    def process(filename, source=None):
+        other = sqlite3.connect(database, timeout=0)
+        try:
+            other.execute('UPDATE feed_state SET version = version')
+            other.commit()
+        except sqlite3.OperationalError as e:
+            blocked.append(str(e))
+        finally:
+            other.close()
+        process_uploaded_image(filename, source)
+
+    monkeypatch.setattr(schoolnet, 'process_uploaded_image', process)
+    with app.test_request_context():
+        schoolnet.store_upload(png_upload('a.png'), '.png')
+        schoolnet.db.session.commit()
+    assert blocked == []
@@ -0,0 +1,53 @@
+"""Per-process cache of logged-in users, so each request doesn't load its user from the database.
+
+Entries are plain column values, not ORM objects, so they can be shared between
+requests and threads safely. Each process keeps its own copy: changes made here
+are invalidated straight away, changes made by other worker processes show up
+once the entry's TTL runs out.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    def __init__(self, ttl=60, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user id -> (columns, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Cached column values for this user, or None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, columns):
+        with self._lock:
+            self._entries[user_id] = (columns, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+            }